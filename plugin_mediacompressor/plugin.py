@@ -1,17 +1,571 @@
 import os
 import hashlib
+import io
 import json
+import logging
+import logging.handlers
+import mmap
+import multiprocessing
 import shutil
+import sqlite3
+import struct
 import subprocess
+import tempfile
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from collections import namedtuple
+from contextlib import ExitStack, closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from mkdocs.plugins import BasePlugin
 from mkdocs.config import config_options
-from PIL import Image, ExifTags
+from PIL import Image, features
+
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+# Pillow builds without LittleCMS lack ImageCms
+try:
+    from PIL import ImageCms
+except ImportError:
+    ImageCms = None
+
+# Under mkdocs.* so MkDocs' own handler, -q/-v and --strict apply; a file
+# that fails to compress is still served as-is, so that is logged at info
+log = logging.getLogger('mkdocs.plugins.mediacompressor')
 
 IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp'}
 VIDEO_EXTENSIONS = {'.mp4', '.webm', '.ogg', '.mov', '.avi', '.mkv'}
+MEDIA_EXTENSIONS = IMAGE_EXTENSIONS | VIDEO_EXTENSIONS
+
+# Containers that can't hold H.264/AAC; these videos are left unchanged
+UNENCODABLE_VIDEO_EXTENSIONS = {'.webm', '.ogg'}
+
+# Containers that accept mov muxer flags such as +faststart
+MOV_EXTENSIONS = {'.mp4', '.mov'}
+
+# Options that affect compressed output; changing any of them clears the cache
+_CONFIG_KEYS = (
+    'image_quality',
+    'image_max_width',
+    'image_max_height',
+    'video_crf',
+    'video_preset',
+    'video_tune',
+    'video_profile',
+    'video_max_width',
+    'video_copy_max_bitrate',
+    'skip_images',
+    'skip_videos',
+    'jpeg_encoder',
+    'video_encoder',
+    'image_backend',
+    'strip_metadata',
+)
+
+# Settings an image worker needs. Workers get this instead of the plugin
+# config, so each task pickles a few hundred bytes
+CompressConfig = namedtuple('CompressConfig', [
+    'image_quality',
+    'image_max_width',
+    'image_max_height',
+    'strip_metadata',
+    'image_backend',
+    'jpeg_encoder',
+    'jpeg_encoder_bin',
+])
+
+# Bumped whenever the layout of the cache manifest changes
+CACHE_VERSION = 3
+
+# EXIF tag holding the image orientation
+EXIF_ORIENTATION = 0x0112
+
+# Formats libvips writes when image_backend resolves to vips; others use Pillow
+VIPS_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+# Modes Image.reduce supports; palette images can't be box-filtered at all
+REDUCE_MODES = {'L', 'LA', 'RGB', 'RGBA', 'CMYK', 'I', 'F'}
+
+# Largest dimension libvips accepts, used as "no limit" for thumbnails
+VIPS_MAX_DIMENSION = 10_000_000
+
+# Compressed output above this fraction of the original size is discarded
+# and the original kept, unless the output had to change (e.g. a resize);
+# a marker file records that for later builds
+NOOP_RATIO = 0.98
+NOOP_SUFFIX = '.noop'
+
+# External JPEG encoders and the binary that provides each one
+JPEG_ENCODERS = {
+    'pillow': None,
+    'mozjpeg': 'cjpeg',
+    'jpegli': 'cjpegli',
+}
+
+# Pixel formats every browser decodes; re-encodes always produce one of these
+BROWSER_PIX_FMTS = {'yuv420p', 'yuvj420p'}
+
+# Supported ffmpeg video encoders; everything but libx264 runs on the GPU
+VIDEO_ENCODERS = ('libx264', 'h264_nvenc', 'hevc_nvenc', 'h264_qsv', 'h264_vaapi')
+
+# NVENC's -cq needs a few points more than x264's CRF for similar quality
+NVENC_CQ_OFFSET = 4
+
+# Render node used for VAAPI encoding
+VAAPI_DEVICE = '/dev/dri/renderD128'
+
+
+def _is_cached_filename(name):
+    """Check whether a file name looks like one written to the cache directory."""
+    file_hash = name[:64]
+    return (
+        len(name) > 64 and name[64] == '.'
+        and all(c in '0123456789abcdef' for c in file_hash)
+    )
+
+
+def _find_media_files(site_dir):
+    """Find all media files under site_dir in a single directory walk."""
+    media_files = []
+    for dirpath, _, filenames in os.walk(site_dir):
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() in MEDIA_EXTENSIONS:
+                media_files.append(Path(dirpath) / filename)
+    return media_files
+
+
+def _replace_file(src, dst):
+    """
+    Replace dst with a hard link to src, or a copy when src is on another
+    filesystem or the filesystem does not support links.
+    """
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # copyfile uses sendfile/copy_file_range where the OS has them
+        shutil.copyfile(src, dst)
+
+
+def _log_savings(media_file, cached_path):
+    """Log how much smaller the cached version is than the original."""
+    original_size = media_file.stat().st_size
+    compressed_size = cached_path.stat().st_size
+    savings = (1 - compressed_size / original_size) * 100
+    log.info(f"[MediaCompressor] {media_file.name}: {original_size:,} → {compressed_size:,} bytes ({savings:.1f}% reduction)")
+
+
+def _cached_paths(cache_dir, media_file, file_hash):
+    """Return the cached file and no-op marker paths for a media file's hash."""
+    cached_file = cache_dir / f"{file_hash}{media_file.suffix}"
+    return cached_file, cache_dir / f"{cached_file.name}{NOOP_SUFFIX}"
+
+
+def _has_faststart(video_path):
+    """Check whether an MP4/MOV file's moov atom comes before its media data."""
+    try:
+        with open(video_path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, box_type = struct.unpack('>I4s', header)
+                if box_type == b'moov':
+                    return True
+                if box_type == b'mdat':
+                    return False
+
+                # Skip to the next top-level box
+                if size == 1:
+                    size = struct.unpack('>Q', f.read(8))[0] - 8
+                elif size < 8:
+                    return False
+                f.seek(size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+
+def _part_path(cache_dir, file_hash, suffix):
+    """Reserve a unique temporary path to write a cached file before renaming it."""
+    fd, name = tempfile.mkstemp(prefix=f"{file_hash}.", suffix=f".part{suffix}", dir=cache_dir)
+    # mkstemp creates owner-only files; site files are hard links to these
+    os.close(fd)
+    os.chmod(name, 0o644)
+    return Path(name)
+
+
+def _compute_file_hash(file_path):
+    """Compute SHA256 hash of a file."""
+    with open(file_path, 'rb', buffering=0) as f:
+        # Python 3.11+: the read loop runs in C
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+        # Older Pythons: hand OpenSSL the whole file in a single update call
+        sha256 = hashlib.sha256()
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sha256.update(mm)
+        return sha256.hexdigest()
+
+
+def _process_with_cache(media_file, cache_dir, compress, file_hash=None):
+    """
+    Replace a media file with its cached compressed version, creating it
+    with compress(media_file, file_hash) on a cache miss. compress returns
+    (compressed_file, required), where required means the output must be
+    used even if it is not smaller, (None, False) if the original cannot be
+    improved on, or None on failure.
+    Returns (file_hash, cached_filename, processed) or None on failure.
+    """
+    # Compute hash of original file unless the caller already has it
+    if file_hash is None:
+        file_hash = _compute_file_hash(media_file)
+
+    # Cached files are named by source hash, so their presence is the hit test
+    cached_file, noop_marker = _cached_paths(cache_dir, media_file, file_hash)
+    if cached_file.exists():
+        _replace_file(cached_file, media_file)
+        return file_hash, cached_file.name, False
+
+    # A marker means compressing did not pay off last time; keep the original
+    if noop_marker.exists():
+        return file_hash, noop_marker.name, False
+
+    # Not cached - need to compress
+    result = compress(media_file, file_hash)
+    compressed_file, required = result or (None, False)
+
+    if result is not None and compressed_file is None:
+        noop_marker.touch()
+        return file_hash, noop_marker.name, True
+
+    if compressed_file and compressed_file.exists():
+        # Size only decides when the original would also have been acceptable
+        if not required and compressed_file.stat().st_size > media_file.stat().st_size * NOOP_RATIO:
+            log.info(f"[MediaCompressor] {media_file.name}: compressed version is not smaller, keeping original")
+            compressed_file.unlink()
+            noop_marker.touch()
+            return file_hash, noop_marker.name, True
+
+        # Replace original with compressed version
+        log.debug(f"[MediaCompressor] Replacing {media_file} with compressed version from {compressed_file}")
+        _replace_file(compressed_file, media_file)
+
+        # Verify the file was replaced
+        new_size = media_file.stat().st_size
+        log.debug(f"[MediaCompressor] Site file now: {new_size:,} bytes")
+        return file_hash, compressed_file.name, True
+
+    log.info(f"[MediaCompressor] Failed to create compressed file for {media_file.name}")
+    return None
+
+
+def _available_cpus():
+    """Count the CPUs this process may run on, honouring its affinity mask."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@contextmanager
+def _worker_log_queue():
+    """
+    Provide a queue that worker processes log to, while a listener thread
+    hands the records to this process's logger so writes stay serialized.
+    """
+    queue = multiprocessing.Queue()
+    # A Logger has handle() and level, so it can stand in for a handler
+    listener = logging.handlers.QueueListener(queue, log)
+    listener.start()
+    try:
+        yield queue
+    finally:
+        listener.stop()
+
+
+def _init_worker(queue, level):
+    """
+    Prepare an image worker process: send its log records to the main
+    process through a queue and keep libvips to one thread, since the
+    pool already runs one worker per CPU.
+    """
+    log.handlers = [logging.handlers.QueueHandler(queue)]
+    log.setLevel(level)
+    log.propagate = False
+
+    if pyvips is not None:
+        pyvips.concurrency_set(1)
+
+
+def _compress_image_worker(image_path, cfg, cache_dir, file_hash=None):
+    """
+    Process an image in a worker process, using only the given CompressConfig.
+    Must stay a module-level function so ProcessPoolExecutor can pickle it.
+    """
+    # Read the file once: the same bytes are hashed and, on a miss, decoded
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    if file_hash is None:
+        file_hash = hashlib.sha256(data).hexdigest()
+
+    return _process_with_cache(
+        image_path, cache_dir,
+        lambda path, file_hash: _compress_image(path, file_hash, cfg, cache_dir, data),
+        file_hash,
+    )
+
+
+def _fix_image_orientation(img):
+    """Fix image orientation based on EXIF data."""
+    try:
+        # Get EXIF data
+        exif = img.getexif()
+        if exif is None:
+            return img
+
+        orientation = exif.get(EXIF_ORIENTATION)
+
+        # Apply rotation based on orientation
+        if orientation == 3:
+            img = img.rotate(180, expand=True)
+        elif orientation == 6:
+            img = img.rotate(270, expand=True)
+        elif orientation == 8:
+            img = img.rotate(90, expand=True)
+
+    except Exception:
+        # If EXIF processing fails, just return the image as-is
+        pass
+
+    return img
+
+
+def _convert_to_srgb(img):
+    """
+    Convert an image with an embedded non-sRGB ICC profile to sRGB, so the
+    profile can be dropped without shifting colours.
+    Returns (img, icc_profile), where icc_profile still has to be saved, if any.
+    """
+    icc_profile = img.info.get('icc_profile')
+    if not icc_profile:
+        return img, None
+    if ImageCms is None or img.mode not in ('RGB', 'RGBA'):
+        # Can't convert here, so keep the profile rather than lose colours
+        return img, icc_profile
+
+    try:
+        profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+        if 'sRGB' in ImageCms.getProfileDescription(profile):
+            return img, None
+        srgb = ImageCms.createProfile('sRGB')
+        return ImageCms.profileToProfile(img, profile, srgb, outputMode=img.mode), None
+    except (ImageCms.PyCMSError, OSError):
+        return img, icc_profile
+
+
+def _compress_image(image_path, file_hash, cfg, cache_dir, data=None):
+    """
+    Compress an image using Pillow with proper orientation handling.
+    If data is given it holds the file's bytes, so the file is not read again.
+    """
+    suffix = image_path.suffix.lower()
+    uses_external_jpeg = suffix in {'.jpg', '.jpeg'} and cfg.jpeg_encoder_bin
+    if cfg.image_backend == 'vips' and suffix in VIPS_EXTENSIONS and not uses_external_jpeg:
+        return _compress_image_vips(image_path, file_hash, cfg, cache_dir, data)
+
+    part_path = None
+    try:
+        img = Image.open(io.BytesIO(data) if data is not None else image_path)
+
+        # Resize if needed (preserves aspect ratio), before rotating so the
+        # rotation works on the smaller image
+        max_width = cfg.image_max_width
+        max_height = cfg.image_max_height
+        resized = False
+
+        if max_width is not None or max_height is not None:
+            # Orientations 6 and 8 rotate by 90°, so the stored image's axes are swapped
+            if img.getexif().get(EXIF_ORIENTATION) in (6, 8):
+                max_width, max_height = max_height, max_width
+
+            width, height = img.size
+            scale = 1.0
+
+            if max_width is not None and width > max_width:
+                scale = min(scale, max_width / width)
+            if max_height is not None and height > max_height:
+                scale = min(scale, max_height / height)
+
+            if scale < 1.0:
+                resized = True
+                new_size = (int(width * scale), int(height * scale))
+
+                # Let libjpeg decode at 1/2, 1/4 or 1/8 scale during the IDCT
+                if image_path.suffix.lower() in {'.jpg', '.jpeg'}:
+                    img.draft('RGB', new_size)
+
+                # Box-filter heavy downscales to about twice the target first,
+                # so LANCZOS only runs on the already reduced image
+                factor = int(img.width / new_size[0] / 2)
+                if factor >= 2 and img.mode in REDUCE_MODES:
+                    img = img.reduce(factor)
+
+                img = img.resize(new_size, Image.Resampling.LANCZOS)
+                log.debug(f"[MediaCompressor] Resized {image_path.name}: {width}x{height} → {new_size[0]}x{new_size[1]}")
+
+        # Fix orientation based on EXIF data
+        img = _fix_image_orientation(img)
+
+        # Metadata is dropped on save by default; when kept, the orientation
+        # tag still goes since the pixels are already rotated. mozjpeg/jpegli
+        # are only given pixels, so their output loses the profile either way
+        if cfg.strip_metadata or uses_external_jpeg:
+            img, icc_profile = _convert_to_srgb(img)
+            metadata = {'exif': b'', 'icc_profile': icc_profile}
+        else:
+            exif = img.getexif()
+            exif.pop(EXIF_ORIENTATION, None)
+            metadata = {'exif': exif.tobytes() if exif else b'', 'icc_profile': img.info.get('icc_profile')}
+
+        # Convert RGBA to RGB if saving as JPEG
+        if img.mode in ('RGBA', 'LA', 'P') and image_path.suffix.lower() in {'.jpg', '.jpeg'}:
+            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            rgb_img.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+            img = rgb_img
+
+        # Save compressed image, writing to a temporary name first so a
+        # half-written file is never mistaken for a cache hit
+        cached_filename = f"{file_hash}{image_path.suffix}"
+        cached_path = cache_dir / cached_filename
+        part_path = _part_path(cache_dir, file_hash, image_path.suffix)
+
+        if uses_external_jpeg and not metadata['icc_profile']:
+            # Encode with mozjpeg/jpegli straight from the decoded buffer;
+            # a profile that couldn't be converted needs Pillow to keep it
+            if not _encode_jpeg_external(img, part_path, cfg):
+                part_path.unlink(missing_ok=True)
+                return None
+        else:
+            save_kwargs = {'optimize': True, **metadata}
+            if image_path.suffix.lower() in {'.jpg', '.jpeg'}:
+                # optimize=True drives libjpeg's optimize_coding (extra Huffman pass)
+                save_kwargs['quality'] = cfg.image_quality
+                save_kwargs['progressive'] = True
+                save_kwargs['subsampling'] = '4:2:0'
+            elif image_path.suffix.lower() == '.png':
+                # optimize=True makes zlib search for the best strategy
+                save_kwargs['compress_level'] = 9
+            elif image_path.suffix.lower() == '.webp':
+                save_kwargs['quality'] = cfg.image_quality
+                save_kwargs['method'] = 6
+
+            img.save(part_path, **save_kwargs)
+
+        os.replace(part_path, cached_path)
+
+        # Show compression stats
+        _log_savings(image_path, cached_path)
+
+        # A resized image has to be used, however its size compares
+        return cached_path, resized
+
+    except Exception as e:
+        log.info(f"[MediaCompressor] Error compressing image {image_path}: {e}", exc_info=log.isEnabledFor(logging.DEBUG))
+        if part_path is not None:
+            part_path.unlink(missing_ok=True)
+        return None
+
+
+def _compress_image_vips(image_path, file_hash, cfg, cache_dir, data=None):
+    """
+    Compress an image with libvips, which decodes, shrinks and encodes in
+    one streaming pipeline and applies EXIF orientation itself.
+    """
+    part_path = None
+    try:
+        if data is None:
+            with open(image_path, 'rb') as f:
+                data = f.read()
+
+        # libvips 8.15 renamed export_profile and strip, and warns about the old names
+        renamed = pyvips.at_least_libvips(8, 15)
+
+        # thumbnail_buffer shrinks while decoding and only ever downsizes;
+        # converting to sRGB lets strip drop the profile without colour shifts
+        profile_kwargs = {}
+        strip_kwargs = {}
+        if cfg.strip_metadata:
+            profile_kwargs = {'output_profile' if renamed else 'export_profile': 'srgb'}
+            strip_kwargs = {'keep': 'none'} if renamed else {'strip': True}
+        img = pyvips.Image.thumbnail_buffer(
+            data,
+            cfg.image_max_width or VIPS_MAX_DIMENSION,
+            height=cfg.image_max_height or VIPS_MAX_DIMENSION,
+            size='down',
+            **profile_kwargs,
+        )
+
+        # Only the header is read; autorotation may swap the axes, so compare areas
+        original = pyvips.Image.new_from_buffer(data, '')
+        resized = img.width * img.height < original.width * original.height
+
+        suffix = image_path.suffix.lower()
+        if suffix in {'.jpg', '.jpeg'}:
+            # Match the Pillow path, which flattens transparency onto white
+            if img.hasalpha():
+                img = img.flatten(background=255)
+            save_kwargs = {'Q': cfg.image_quality, 'optimize_coding': True, 'interlace': True}
+        elif suffix == '.png':
+            save_kwargs = {'compression': 9}
+        else:
+            save_kwargs = {'Q': cfg.image_quality, 'effort': 6}
+
+        # See _compress_image for why a temporary name is used
+        cached_path = cache_dir / f"{file_hash}{image_path.suffix}"
+        part_path = _part_path(cache_dir, file_hash, image_path.suffix)
+        img.write_to_file(str(part_path), **strip_kwargs, **save_kwargs)
+        os.replace(part_path, cached_path)
+
+        # Show compression stats
+        _log_savings(image_path, cached_path)
+
+        return cached_path, resized
+
+    except Exception as e:
+        log.info(f"[MediaCompressor] Error compressing image {image_path}: {e}", exc_info=log.isEnabledFor(logging.DEBUG))
+        if part_path is not None:
+            part_path.unlink(missing_ok=True)
+        return None
+
+
+def _encode_jpeg_external(img, out_path, cfg):
+    """Encode an image with cjpeg (mozjpeg) or cjpegli by piping a PPM to stdin."""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    quality = str(cfg.image_quality)
+    if cfg.jpeg_encoder == 'jpegli':
+        cmd = [cfg.jpeg_encoder_bin, '-', '-', '-q', quality]
+    else:
+        cmd = [cfg.jpeg_encoder_bin, '-quality', quality, '-optimize', '-progressive']
+
+    # Raw PPM header + pixels, so the encoder never re-decodes the source
+    width, height = img.size
+    ppm = f"P6\n{width} {height}\n255\n".encode('ascii') + img.tobytes()
+
+    with open(out_path, 'wb') as out:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out, stderr=subprocess.PIPE)
+        _, stderr = proc.communicate(ppm)
+
+    if proc.returncode != 0:
+        log.info(f"[MediaCompressor] {cfg.jpeg_encoder} error: {stderr.decode(errors='replace')}")
+        return False
+    return True
+
 
 class MediaCompressorPlugin(BasePlugin):
     """
@@ -24,473 +578,718 @@ class MediaCompressorPlugin(BasePlugin):
         ('image_quality', config_options.Type(int, default=85)),
         ('image_max_width', config_options.Type(int, default=None)),
         ('image_max_height', config_options.Type(int, default=None)),
+        ('strip_metadata', config_options.Type(bool, default=True)),
         ('video_crf', config_options.Type(int, default=23)),
-        ('video_preset', config_options.Type(str, default='medium')),
+        ('video_preset', config_options.Type(str, default='faster')),
+        ('video_tune', config_options.Type(str, default=None)),
+        ('video_profile', config_options.Type(str, default=None)),
         ('video_max_width', config_options.Type(int, default=None)),
+        ('video_copy_max_bitrate', config_options.Type(int, default=None)),
         ('skip_images', config_options.Type(bool, default=False)),
         ('skip_videos', config_options.Type(bool, default=False)),
         ('max_workers', config_options.Type(int, default=4)),
+        ('video_batch_size', config_options.Type(int, default=1)),
+        ('jpeg_encoder', config_options.Choice(tuple(JPEG_ENCODERS), default='pillow')),
+        ('image_backend', config_options.Choice(('auto', 'pillow', 'vips'), default='auto')),
+        ('video_encoder', config_options.Choice(VIDEO_ENCODERS, default='libx264')),
     )
 
     def on_config(self, config):
         """Initialize cache and validate configuration."""
         self.docs_dir = Path(config['docs_dir']).parent
         self.cache_dir = self.docs_dir / self.config['cache_dir']
-        self.cache_file = self.cache_dir / '.cache.json'
-        self.cache_lock = Lock()
+        self.cache_file = self.cache_dir / '.cache.sqlite3'
+        self.media_sources = {}
         
         # Ensure cache directory exists
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         
+        # Resolve the JPEG encoder before the cache so a fallback invalidates it
+        self._resolve_jpeg_encoder()
+        self._resolve_image_backend()
+        self._resolve_ffmpeg()
+        
         # Load or initialize cache
         self._load_cache()
         
+        # Resolved after the cache snapshot so a missing ffmpeg or GPU, which
+        # only affects videos, does not invalidate cached images
+        self._resolve_video_encoder()
+        if not self._ffmpeg_bin and not self.config['skip_videos']:
+            log.info("[MediaCompressor] ffmpeg not found, skipping video compression")
+            self.config['skip_videos'] = True
+        
         return config
 
+    def _resolve_jpeg_encoder(self):
+        """Locate the configured JPEG encoder, falling back to Pillow if missing."""
+        self._jpeg_encoder_bin = None
+        encoder = self.config['jpeg_encoder']
+        
+        if encoder != 'pillow':
+            self._jpeg_encoder_bin = shutil.which(JPEG_ENCODERS[encoder])
+            if not self._jpeg_encoder_bin:
+                log.info(f"[MediaCompressor] {JPEG_ENCODERS[encoder]} not found, falling back to Pillow for JPEG encoding")
+                self.config['jpeg_encoder'] = encoder = 'pillow'
+        
+        if encoder == 'pillow' and not features.check_feature('libjpeg_turbo'):
+            log.info("[MediaCompressor] Pillow is not built against libjpeg-turbo, JPEG encoding will be slow")
+
+    def _resolve_image_backend(self):
+        """Pick libvips when requested or available, falling back to Pillow."""
+        backend = self.config['image_backend']
+        if backend == 'vips' and pyvips is None:
+            log.info("[MediaCompressor] pyvips not installed, falling back to Pillow for images")
+        if backend in ('auto', 'vips'):
+            self.config['image_backend'] = 'vips' if pyvips is not None else 'pillow'
+
+    def _resolve_ffmpeg(self):
+        """Locate ffmpeg and ffprobe once per build instead of once per video."""
+        self._ffmpeg_bin = shutil.which('ffmpeg')
+        self._ffprobe_bin = shutil.which('ffprobe')
+
+    def _resolve_video_encoder(self):
+        """Check that the configured video encoder works here, falling back to libx264."""
+        encoder = self.config['video_encoder']
+        if encoder == 'libx264' or self.config['skip_videos'] or not self._ffmpeg_bin:
+            return
+        
+        # Static ffmpeg builds list GPU encoders even without a GPU, so
+        # encode a single blank frame instead of reading -encoders
+        test_filter = ['-vf', 'format=nv12,hwupload'] if encoder.endswith('_vaapi') else []
+        try:
+            works = subprocess.run(
+                [
+                    self._ffmpeg_bin, '-hide_banner', *self._global_args(),
+                    '-f', 'lavfi', '-i', 'nullsrc=s=256x256', '-frames:v', '1',
+                    *test_filter, '-c:v', encoder, '-f', 'null', '-',
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            ).returncode == 0
+        except OSError:
+            works = False
+        
+        if not works:
+            log.info(f"[MediaCompressor] ffmpeg encoder {encoder} not available, falling back to libx264")
+            self.config['video_encoder'] = 'libx264'
+
+    def on_files(self, files, config):
+        """Remember the source of each media file so it can be stat'ed later."""
+        # Site files are rewritten on every build, so only the source
+        # keeps a stable mtime between runs
+        self.media_sources = {}
+        for file in files:
+            if file.abs_src_path and Path(file.abs_dest_path).suffix.lower() in MEDIA_EXTENSIONS:
+                dest_path = Path(file.abs_dest_path)
+                self.media_sources[dest_path] = Path(file.abs_src_path)
+
+                # Site files may be hard links into the cache; drop them so a
+                # dirty build copies a fresh file instead of writing into the cache
+                try:
+                    if dest_path.stat().st_nlink > 1:
+                        dest_path.unlink()
+                except FileNotFoundError:
+                    pass
+        return files
+
     def on_post_build(self, config):
         """
         Compress images and videos in the site directory after build completes.
         """
         site_dir = Path(config['site_dir'])
         
-        print("[MediaCompressor] Starting media compression...")
+        log.info("[MediaCompressor] Starting media compression...")
         
         # Find all media files in site directory
-        media_files = []
-        for ext in IMAGE_EXTENSIONS | VIDEO_EXTENSIONS:
-            media_files.extend(site_dir.rglob(f'*{ext}'))
+        media_files = _find_media_files(site_dir)
         
         if not media_files:
-            print("[MediaCompressor] No media files found.")
+            log.info("[MediaCompressor] No media files found.")
             return
         
-        # Clean cache of orphaned files
-        self._clean_orphaned_cache()
-        
         # Process files in parallel
         processed = 0
         skipped = 0
         errors = 0
         
         max_workers = self.config.get('max_workers', 4)
-        
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Submit all tasks
-            future_to_file = {
-                executor.submit(self._process_media_file, media_file, site_dir): media_file 
-                for media_file in media_files
-            }
-            
-            # Collect results as they complete
-            for future in as_completed(future_to_file):
-                media_file = future_to_file[future]
+
+        # Previous manifest entries; only files seen in this build are kept
+        previous_cache = self.cache
+        self.cache = {}
+
+        # Images are CPU-bound in Pillow, so they get real processes;
+        # videos only wait on ffmpeg subprocesses, so threads suffice
+        images = []
+        videos = []
+        for media_file in media_files:
+            ext = media_file.suffix.lower()
+            if ext in IMAGE_EXTENSIONS and not self.config['skip_images']:
+                jobs = images
+            elif (
+                ext in VIDEO_EXTENSIONS and ext not in UNENCODABLE_VIDEO_EXTENSIONS
+                and not self.config['skip_videos']
+            ):
+                jobs = videos
+            else:
+                skipped += 1
+                continue
+
+            # Unchanged sources are restored from cache without being hashed
+            rel_path = media_file.relative_to(site_dir).as_posix()
+            try:
+                source_stat = self._source_path(media_file).stat()
+                if self._restore_unchanged(media_file, rel_path, source_stat, previous_cache):
+                    skipped += 1
+                    continue
+            except OSError as e:
+                log.info(f"[MediaCompressor] Error processing {media_file}: {e}")
+                errors += 1
+                continue
+
+            jobs.append((media_file, rel_path, source_stat))
+
+        # Identical files are compressed once and linked to the result
+        images, image_hashes, image_duplicates, image_errors = self._group_duplicates(images)
+        videos, video_hashes, video_duplicates, video_errors = self._group_duplicates(videos)
+        errors += image_errors + video_errors
+        known_hashes = {**image_hashes, **video_hashes}
+        duplicates = {**image_duplicates, **video_duplicates}
+
+        image_cfg = CompressConfig(
+            image_quality=self.config['image_quality'],
+            image_max_width=self.config['image_max_width'],
+            image_max_height=self.config['image_max_height'],
+            strip_metadata=self.config['strip_metadata'],
+            image_backend=self.config['image_backend'],
+            jpeg_encoder=self.config['jpeg_encoder'],
+            jpeg_encoder_bin=self._jpeg_encoder_bin,
+        )
+
+        with ExitStack() as stack:
+            db = stack.enter_context(closing(self._connect()))
+            video_executor = stack.enter_context(ThreadPoolExecutor(max_workers=max_workers))
+
+            # Submit all tasks; each future covers a list of jobs
+            future_to_jobs = {}
+            if images:
+                # Worker processes only pay off when there is something to decode
+                log_queue = stack.enter_context(_worker_log_queue())
+                image_executor = stack.enter_context(ProcessPoolExecutor(
+                    max_workers=min(_available_cpus(), len(images)),
+                    initializer=_init_worker,
+                    initargs=(log_queue, log.getEffectiveLevel()),
+                ))
+                for job in images:
+                    future = image_executor.submit(
+                        _compress_image_worker, job[0], image_cfg, self.cache_dir, known_hashes.get(job[0])
+                    )
+                    future_to_jobs[future] = [job]
+
+            batch_size = max(1, self.config['video_batch_size'])
+            for start in range(0, len(videos), batch_size):
+                batch = videos[start:start + batch_size]
+                future = video_executor.submit(
+                    self._process_video_batch, [(job[0], known_hashes.get(job[0])) for job in batch]
+                )
+                future_to_jobs[future] = batch
+
+            # Collect results as they complete, merging cache updates here
+            for future in as_completed(future_to_jobs):
+                jobs = future_to_jobs[future]
                 try:
-                    result = future.result()
-                    if result:
-                        processed += 1
-                    else:
-                        skipped += 1
+                    results = future.result()
                 except Exception as e:
-                    print(f"[MediaCompressor] Error processing {media_file}: {e}")
-                    errors += 1
-        
-        # Save cache after all processing is complete
-        self._save_cache()
-        
-        print(f"[MediaCompressor] Complete: {processed} processed, {skipped} skipped (cached), {errors} errors")
+                    for job in jobs:
+                        log.info(f"[MediaCompressor] Error processing {job[0]}: {e}")
+                        errors += 1 + len(duplicates.get(job[0], []))
+                    continue
 
-    def _load_cache(self):
-        """Load cache from disk."""
-        self.cache_dir.mkdir(parents=True, exist_ok=True)
+                # Image workers return one result, video batches a list
+                if not isinstance(results, list):
+                    results = [results]
+
+                for job, result in zip(jobs, results):
+                    duplicate_jobs = duplicates.get(job[0], [])
+                    try:
+                        if result is None:
+                            skipped += 1 + len(duplicate_jobs)
+                            continue
+
+                        file_hash, cached_filename, was_processed = result
+                        self._record_cache_entry(db, job, file_hash, cached_filename)
+                        if was_processed:
+                            processed += 1
+                        else:
+                            skipped += 1
+
+                        # Duplicates reuse the result without hashing or encoding again
+                        for duplicate_job in duplicate_jobs:
+                            if not cached_filename.endswith(NOOP_SUFFIX):
+                                _replace_file(self.cache_dir / cached_filename, duplicate_job[0])
+                            self._record_cache_entry(db, duplicate_job, file_hash, cached_filename)
+                            skipped += 1
+                    except Exception as e:
+                        log.info(f"[MediaCompressor] Error processing {job[0]}: {e}")
+                        errors += 1 + len(duplicate_jobs)
+
+            # Drop entries for files that are no longer part of the site
+            db.executemany(
+                'DELETE FROM files WHERE path = ?',
+                [(rel_path,) for rel_path in previous_cache if rel_path not in self.cache],
+            )
+            db.commit()
         
-        if self.cache_file.exists():
-            try:
-                with open(self.cache_file, 'r') as f:
-                    cache_data = json.load(f)
-                    
-                # Cache format: { "config": {...}, "files": {...} }
-                if isinstance(cache_data, dict) and "config" in cache_data:
-                    # Check if config changed
-                    current_config = self._get_current_config()
-                    if cache_data["config"] != current_config:
-                        print("[MediaCompressor] Configuration changed, clearing cache...")
-                        print("[MediaCompressor] Config differences:")
-                        for key in current_config:
-                            old_val = cache_data["config"].get(key)
-                            new_val = current_config.get(key)
-                            if old_val != new_val:
-                                print(f"  {key}: {old_val} → {new_val}")
-                        self.cache = {}
-                        return
-                    
-                    self.cache = cache_data.get("files", {})
+        log.info(f"[MediaCompressor] Complete: {processed} processed, {skipped} skipped (cached), {errors} errors")
+
+    def _source_path(self, media_file):
+        """Return the file a site media file was copied from, or itself if unknown."""
+        return self.media_sources.get(media_file, media_file)
+
+    def _group_duplicates(self, jobs):
+        """
+        Collapse jobs for files with identical content into one job per content.
+        Returns (unique_jobs, file_hashes, duplicates, errors): hashes already
+        computed for the kept jobs, the jobs that can reuse each kept job's
+        result, and the number of files that could not be read.
+        """
+        # Only files sharing a size can be identical, so the rest are never hashed here
+        by_size = {}
+        for job in jobs:
+            by_size.setdefault(job[2].st_size, []).append(job)
+
+        unique_jobs = []
+        file_hashes = {}
+        duplicates = {}
+        errors = 0
+        for bucket in by_size.values():
+            if len(bucket) == 1:
+                unique_jobs.append(bucket[0])
+                continue
+
+            inode_hashes = {}
+            primaries = {}
+            for job in bucket:
+                media_file, _, source_stat = job
+
+                # Paths sharing an inode are the same file and need a single hash
+                inode = (source_stat.st_dev, source_stat.st_ino)
+                if inode not in inode_hashes:
+                    try:
+                        inode_hashes[inode] = _compute_file_hash(media_file)
+                    except OSError as e:
+                        log.info(f"[MediaCompressor] Error processing {media_file}: {e}")
+                        errors += 1
+                        continue
+                file_hash = inode_hashes[inode]
+
+                # Output is encoded for the primary's format, so only files
+                # with the same extension can share it
+                key = (file_hash, media_file.suffix.lower())
+                primary = primaries.get(key)
+                if primary is None:
+                    primaries[key] = job
+                    unique_jobs.append(job)
+                    file_hashes[media_file] = file_hash
                 else:
-                    # Old cache format without config, clear it
-                    print("[MediaCompressor] Old cache format detected, clearing...")
-                    self.cache = {}
-            except Exception as e:
-                print(f"[MediaCompressor] Error loading cache: {e}")
-                self.cache = {}
-        else:
-            self.cache = {}
+                    duplicates.setdefault(primary[0], []).append(job)
 
-    def _save_cache(self):
-        """Save cache to disk with config snapshot."""
-        try:
-            cache_data = {
-                "config": self._get_current_config(),
-                "files": self.cache
-            }
-            with open(self.cache_file, 'w') as f:
-                json.dump(cache_data, f, indent=2)
-        except Exception as e:
-            print(f"[MediaCompressor] Error saving cache: {e}")
+        return unique_jobs, file_hashes, duplicates, errors
 
-    def _get_current_config(self):
-        """Get current configuration values from mkdocs.yml."""
-        return {
-            'image_quality': self.config.get('image_quality'),
-            'image_max_width': self.config.get('image_max_width'),
-            'image_max_height': self.config.get('image_max_height'),
-            'video_crf': self.config.get('video_crf'),
-            'video_preset': self.config.get('video_preset'),
-            'video_max_width': self.config.get('video_max_width'),
-            'skip_images': self.config.get('skip_images'),
-            'skip_videos': self.config.get('skip_videos'),
+    def _record_cache_entry(self, db, job, file_hash, cached_filename):
+        """Store the manifest entry for a processed media file."""
+        _, rel_path, source_stat = job
+        cache_entry = {
+            'mtime': source_stat.st_mtime_ns,
+            'size': source_stat.st_size,
+            'sha256': file_hash,
+            'cached_filename': cached_filename,
+            'noop': cached_filename.endswith(NOOP_SUFFIX),
         }
+        self.cache[rel_path] = cache_entry
 
-    def _save_config(self):
-        """Save current configuration to disk."""
-        config_data = self._get_current_config()
-        try:
-            with open(self.config_file, 'w') as f:
-                json.dump(config_data, f, indent=2)
-        except Exception as e:
-            print(f"[MediaCompressor] Error saving config: {e}")
+        # Committed right away so an interrupted build keeps its progress
+        db.execute(
+            'INSERT OR REPLACE INTO files (path, mtime, size, sha256, cached_filename, noop) '
+            'VALUES (:path, :mtime, :size, :sha256, :cached_filename, :noop)',
+            {'path': rel_path, **cache_entry},
+        )
+        db.commit()
 
-    def _save_cached_config(self):
-        """Save a snapshot of the config in the cache directory."""
-        try:
-            current_config = self._get_current_config()
-            with open(self.cached_config_file, 'w') as f:
-                json.dump(current_config, f, indent=2)
-        except Exception as e:
-            print(f"[MediaCompressor] Error saving cached config: {e}")
+    def _restore_unchanged(self, media_file, rel_path, source_stat, previous_cache):
+        """
+        Restore a media file from cache if its source mtime and size match
+        the previous build. Returns True if it was restored.
+        """
+        cache_entry = previous_cache.get(rel_path)
+        if not cache_entry:
+            return False
+        if cache_entry.get('mtime') != source_stat.st_mtime_ns or cache_entry.get('size') != source_stat.st_size:
+            return False
 
-    def _load_or_create_config(self):
-        """Load existing config file or create with defaults from mkdocs.yml."""
-        if self.config_file.exists():
-            try:
-                with open(self.config_file, 'r') as f:
-                    file_config = json.load(f)
-                
-                # Get current config from mkdocs.yml
+        cached_file = self.cache_dir / cache_entry['cached_filename']
+        if not cached_file.exists():
+            return False
+
+        # For noop entries the original is already the best version
+        if not cache_entry.get('noop'):
+            _replace_file(cached_file, media_file)
+        self.cache[rel_path] = cache_entry
+        return True
+
+    def _connect(self):
+        """Open the SQLite cache manifest, creating its tables if needed."""
+        db = sqlite3.connect(self.cache_file)
+        # WAL keeps the per-file commits cheap
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, '
+            'sha256 TEXT, cached_filename TEXT, noop INTEGER)'
+        )
+        return db
+
+    def _load_cache(self, retry=True):
+        """Load cache from disk."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache = {}
+        
+        # Manifest written by versions before the SQLite cache
+        (self.cache_dir / '.cache.json').unlink(missing_ok=True)
+        
+        is_new = not self.cache_file.exists()
+        try:
+            with closing(self._connect()) as db:
+                meta = dict(db.execute('SELECT key, value FROM meta'))
                 current_config = self._get_current_config()
                 
-                # Check if any parameters are missing and add defaults
-                updated = False
-                for key, value in current_config.items():
-                    if key not in file_config:
-                        file_config[key] = value
-                        updated = True
-                        print(f"[MediaCompressor] Added missing config parameter: {key} = {value}")
-                
-                # Save if we added any defaults
-                if updated:
-                    with open(self.config_file, 'w') as f:
-                        json.dump(file_config, f, indent=2)
-                    print("[MediaCompressor] Updated config file with missing parameters")
+                if is_new:
+                    # No manifest, so leftover cached files have an unknown config
+                    self._clear_cache(db)
+                elif meta.get('version') != str(CACHE_VERSION):
+                    log.info("[MediaCompressor] Old cache format detected, clearing...")
+                    self._clear_cache(db)
+                else:
+                    # Check if config changed
+                    cached_config = json.loads(meta.get('config', '{}'))
+                    if cached_config != current_config:
+                        log.info("[MediaCompressor] Configuration changed, clearing cache...")
+                        log.info("[MediaCompressor] Config differences:")
+                        for key in current_config:
+                            old_val = cached_config.get(key)
+                            new_val = current_config.get(key)
+                            if old_val != new_val:
+                                log.info(f"  {key}: {old_val} → {new_val}")
+                        self._clear_cache(db)
+                    else:
+                        self._clean_orphaned_cache(db)
+                        for rel_path, mtime, size, sha256, cached_filename, noop in db.execute(
+                            'SELECT path, mtime, size, sha256, cached_filename, noop FROM files'
+                        ):
+                            self.cache[rel_path] = {
+                                'mtime': mtime,
+                                'size': size,
+                                'sha256': sha256,
+                                'cached_filename': cached_filename,
+                                'noop': bool(noop),
+                            }
                 
-            except Exception as e:
-                print(f"[MediaCompressor] Error loading config, creating new: {e}")
-                self._save_config()
-        else:
-            # Create new config file with current settings
-            self._save_config()
-            print("[MediaCompressor] Created new config file")
-    
+                db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('version', str(CACHE_VERSION)))
+                db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('config', json.dumps(current_config)))
+                db.commit()
+        except sqlite3.DatabaseError as e:
+            log.warning(f"[MediaCompressor] Error loading cache: {e}")
+            for suffix in ('', '-wal', '-shm'):
+                Path(f"{self.cache_file}{suffix}").unlink(missing_ok=True)
+            if retry:
+                # Start over with a fresh manifest, stamped with the version and config
+                self._load_cache(retry=False)
+            else:
+                self._clear_cache()
+
     def _get_current_config(self):
         """Get current configuration values from mkdocs.yml."""
-        return {
-            'image_quality': self.config.get('image_quality'),
-            'image_max_width': self.config.get('image_max_width'),
-            'image_max_height': self.config.get('image_max_height'),
-            'video_crf': self.config.get('video_crf'),
-            'video_preset': self.config.get('video_preset'),
-            'video_max_width': self.config.get('video_max_width'),
-            'skip_images': self.config.get('skip_images'),
-            'skip_videos': self.config.get('skip_videos'),
-        }
-    
-    def _save_cached_config(self):
-        """Save a snapshot of the config in the cache directory."""
-        try:
-            current_config = self._get_current_config()
-            with open(self.cached_config_file, 'w') as f:
-                json.dump(current_config, f, indent=2)
-        except Exception as e:
-            print(f"[MediaCompressor] Error saving cached config: {e}")
-        """Save current configuration to disk."""
-        config_data = {
-            'image_quality': self.config['image_quality'],
-            'image_max_width': self.config['image_max_width'],
-            'image_max_height': self.config['image_max_height'],
-            'video_crf': self.config['video_crf'],
-            'video_preset': self.config['video_preset'],
-            'video_max_width': self.config['video_max_width'],
-            'skip_images': self.config['skip_images'],
-            'skip_videos': self.config['skip_videos'],
-        }
-        try:
-            with open(self.config_file, 'w') as f:
-                json.dump(config_data, f, indent=2)
-        except Exception as e:
-            print(f"[MediaCompressor] Error saving config: {e}")
-
-    def _config_changed(self):
-        """Check if configuration has changed by comparing with cached snapshot."""
-        current_config = self._get_current_config()
-        
-        # Check the cached config in the cache directory (primary source of truth)
-        if self.cached_config_file.exists():
-            try:
-                with open(self.cached_config_file, 'r') as f:
-                    cached_config = json.load(f)
-                
-                if cached_config != current_config:
-                    print("[MediaCompressor] Config differences detected:")
-                    for key in current_config:
-                        old_val = cached_config.get(key)
-                        new_val = current_config.get(key)
-                        if old_val != new_val:
-                            print(f"  {key}: {old_val} → {new_val}")
-                    return True
-                return False
-                
-            except Exception as e:
-                print(f"[MediaCompressor] Error reading cached config: {e}")
-                return True
-        
-        # No cached config exists - this is a first run
-        print("[MediaCompressor] No cached config found, first run")
-        return True
+        return {key: self.config.get(key) for key in _CONFIG_KEYS}
 
-    def _clear_cache(self):
+    def _clear_cache(self, db=None):
         """Clear all cached files and cache data."""
+        # Cached files are found by name in worker processes, so stale ones
+        # from a previous config must not survive
         if self.cache_dir.exists():
-            shutil.rmtree(self.cache_dir)
-            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            for path in self.cache_dir.iterdir():
+                if path.is_file() and _is_cached_filename(path.name):
+                    path.unlink()
+        if db is not None:
+            db.execute('DELETE FROM files')
         self.cache = {}
 
-    def _clean_orphaned_cache(self):
-        """Remove cached files that no longer have originals."""
-        orphaned = []
-        for file_hash in list(self.cache.keys()):
-            cache_entry = self.cache[file_hash]
-            cached_file = self.cache_dir / cache_entry['cached_filename']
-            
-            # If cached file doesn't exist, remove from cache
-            if not cached_file.exists():
-                orphaned.append(file_hash)
-        
-        for file_hash in orphaned:
-            del self.cache[file_hash]
+    def _clean_orphaned_cache(self, db):
+        """Remove cache entries whose cached file no longer exists."""
+        existing = set(os.listdir(self.cache_dir))
+        orphaned = [
+            (rel_path,)
+            for rel_path, cached_filename in db.execute('SELECT path, cached_filename FROM files')
+            if cached_filename not in existing
+        ]
+        db.executemany('DELETE FROM files WHERE path = ?', orphaned)
         
         if orphaned:
-            print(f"[MediaCompressor] Cleaned {len(orphaned)} orphaned cache entries")
+            log.info(f"[MediaCompressor] Cleaned {len(orphaned)} orphaned cache entries")
 
-    def _compute_file_hash(self, file_path):
-        """Compute SHA256 hash of a file."""
-        sha256 = hashlib.sha256()
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(8192), b''):
-                sha256.update(chunk)
-        return sha256.hexdigest()
+    def _process_video_batch(self, videos):
+        """
+        Process a batch of (video_file, file_hash) pairs, encoding all cache
+        misses with a single ffmpeg process.
+        Returns a list of (file_hash, cached_filename, processed) or None,
+        in input order.
+        """
+        # Each video is probed at most once, and only on a cache miss
+        streams = {}
+        def probe(media_file):
+            if media_file not in streams:
+                streams[media_file] = self._probe_video(media_file)
+            return streams[media_file]
+        
+        hashed = []
+        to_encode = []
+        for media_file, file_hash in videos:
+            if file_hash is None:
+                file_hash = _compute_file_hash(media_file)
+            hashed.append((media_file, file_hash))
+            
+            if len(videos) == 1:
+                continue
+            if any(path.exists() for path in _cached_paths(self.cache_dir, media_file, file_hash)):
+                continue
+            if not self._can_copy_video(probe(media_file)):
+                to_encode.append((media_file, file_hash))
+        
+        encoded = self._encode_videos(to_encode) if len(to_encode) > 1 else {}
+        
+        def compress(media_file, file_hash):
+            part_path = encoded.pop(media_file, None)
+            if part_path is None:
+                # Not produced by the batch (remux or failure); encode on its own
+                return self._compress_video(media_file, file_hash, probe(media_file))
+            
+            cached_path = self.cache_dir / f"{file_hash}{media_file.suffix}"
+            os.replace(part_path, cached_path)
+            _log_savings(media_file, cached_path)
+            return cached_path, self._must_replace_video(media_file, probe(media_file))
+        
+        try:
+            return [
+                _process_with_cache(media_file, self.cache_dir, compress, file_hash)
+                for media_file, file_hash in hashed
+            ]
+        finally:
+            for part_path in encoded.values():
+                part_path.unlink(missing_ok=True)
 
-    def _process_media_file(self, media_file, site_dir):
+    def _probe_video(self, video_path):
         """
-        Process a media file: compress and replace with cached version.
-        Returns True if processed, False if skipped (cached).
+        Return codec_name, width, pix_fmt and bit_rate of the first video stream,
+        plus the audio_codec of the first audio stream (None without audio), or None.
         """
-        ext = media_file.suffix.lower()
+        if not self._ffprobe_bin:
+            return None
         
-        # Skip based on config
-        if ext in IMAGE_EXTENSIONS and self.config['skip_images']:
-            return False
-        if ext in VIDEO_EXTENSIONS and self.config['skip_videos']:
+        result = subprocess.run(
+            [
+                self._ffprobe_bin, '-v', 'error',
+                '-show_entries', 'stream=codec_type,codec_name,width,pix_fmt,bit_rate', '-of', 'json',
+                str(video_path),
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        if result.returncode != 0:
+            return None
+        streams = json.loads(result.stdout).get('streams') or []
+        video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+        if video is not None:
+            audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+            video['audio_codec'] = audio.get('codec_name')
+        return video
+
+    def _can_copy_video(self, stream):
+        """
+        Check whether a probed video is already H.264 within the bitrate and width
+        limits, with AAC or no audio, so its streams can be kept as they are.
+        """
+        max_bitrate = self.config['video_copy_max_bitrate']
+        if not max_bitrate:
             return False
         
-        # Compute hash of original file
-        file_hash = self._compute_file_hash(media_file)
+        if not stream or stream.get('codec_name') != 'h264':
+            return False
         
-        # Check if already cached and up-to-date (thread-safe read)
-        with self.cache_lock:
-            if file_hash in self.cache:
-                cache_entry = self.cache[file_hash]
-                cached_file = self.cache_dir / cache_entry['cached_filename']
-                
-                if cached_file.exists():
-                    # Use cached version
-                    shutil.copy2(cached_file, media_file)
-                    return False
+        # Other audio codecs, e.g. PCM or AC-3, don't play in every browser
+        if stream.get('audio_codec') not in (None, 'aac'):
+            return False
         
-        # Not cached - need to compress
-        if ext in IMAGE_EXTENSIONS:
-            compressed_file = self._compress_image(media_file, file_hash)
-        elif ext in VIDEO_EXTENSIONS:
-            compressed_file = self._compress_video(media_file, file_hash)
-        else:
+        try:
+            bit_rate = int(stream['bit_rate'])
+            width = int(stream['width'])
+        except (KeyError, ValueError):
             return False
         
-        if compressed_file and compressed_file.exists():
-            # Update cache (thread-safe write)
-            with self.cache_lock:
-                self.cache[file_hash] = {
-                    'cached_filename': compressed_file.name,
-                    'original_hash': file_hash,
-                }
-            
-            # Replace original with compressed version
-            print(f"[MediaCompressor] Replacing {media_file} with compressed version from {compressed_file}")
-            shutil.copy2(compressed_file, media_file)
-            
-            # Verify the file was replaced
-            new_size = media_file.stat().st_size
-            print(f"[MediaCompressor] Site file now: {new_size:,} bytes")
+        max_width = self.config['video_max_width']
+        return bit_rate <= max_bitrate * 1000 and (not max_width or width <= max_width)
+
+    def _must_replace_video(self, video_path, stream):
+        """
+        Check whether a re-encode has to be used even if it is not smaller,
+        because the original breaks a limit or would play poorly in browsers.
+        """
+        if stream is None:
+            # Without ffprobe the limits can't be checked, so assume they apply
             return True
         
-        print(f"[MediaCompressor] Failed to create compressed file for {media_file.name}")
-        return False
+        max_width = self.config['video_max_width']
+        if max_width and int(stream.get('width') or 0) > max_width:
+            return True
+        if stream.get('pix_fmt') not in BROWSER_PIX_FMTS:
+            return True
+        return video_path.suffix.lower() in MOV_EXTENSIONS and not _has_faststart(video_path)
 
-    def _fix_image_orientation(self, img):
-        """Fix image orientation based on EXIF data."""
-        try:
-            # Get EXIF data
-            exif = img.getexif()
-            if exif is None:
-                return img
-            
-            # Find orientation tag
-            orientation = None
-            for tag, value in exif.items():
-                if tag in ExifTags.TAGS and ExifTags.TAGS[tag] == 'Orientation':
-                    orientation = value
-                    break
-            
-            # Apply rotation based on orientation
-            if orientation == 3:
-                img = img.rotate(180, expand=True)
-            elif orientation == 6:
-                img = img.rotate(270, expand=True)
-            elif orientation == 8:
-                img = img.rotate(90, expand=True)
-            
-            # Remove EXIF orientation tag to prevent double rotation
-            if orientation is not None and hasattr(img, 'getexif'):
-                exif_dict = img.getexif()
-                if exif_dict:
-                    for tag in ExifTags.TAGS.keys():
-                        if ExifTags.TAGS[tag] == 'Orientation':
-                            if tag in exif_dict:
-                                del exif_dict[tag]
-                            break
-            
-        except Exception:
-            # If EXIF processing fails, just return the image as-is
-            pass
+    def _global_args(self):
+        """ffmpeg options that must appear once per command for the configured encoder."""
+        if self.config['video_encoder'].endswith('_vaapi'):
+            return ['-vaapi_device', VAAPI_DEVICE]
+        return []
+
+    def _input_args(self):
+        """ffmpeg options placed before each input for the configured encoder."""
+        if self.config['video_encoder'].endswith('_nvenc'):
+            # Keep decoded frames on the GPU for the encoder
+            return ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda']
+        return []
+
+    def _output_args(self, suffix):
+        """ffmpeg options placed before each output that re-encode a video to suffix."""
+        encoder = self.config['video_encoder']
+        crf = self.config['video_crf']
+        filters = []
+        
+        # Resize if needed
+        max_width = self.config['video_max_width']
+        if encoder.endswith('_nvenc'):
+            # Frames stay on the GPU, where only scale_cuda can convert 4:4:4 or
+            # 10-bit sources to 8-bit 4:2:0, which browsers can play
+            size = f"'min({max_width},iw)':-2:" if max_width else ''
+            filters.append(f"scale_cuda={size}format=yuv420p")
+        elif max_width:
+            filters.append(f"scale='min({max_width},iw)':-2")
         
-        return img
+        # Upload frames to the GPU for VAAPI
+        if encoder.endswith('_vaapi'):
+            filters.extend(['format=nv12', 'hwupload'])
+        
+        # Video codec settings
+        args = ['-c:v', encoder]
+        if encoder == 'libx264':
+            args.extend(['-crf', str(crf)])
+            args.extend(['-preset', self.config['video_preset']])
+            if self.config['video_tune']:
+                args.extend(['-tune', self.config['video_tune']])
+            # 4:4:4 or 10-bit sources would otherwise stay that way, which browsers can't play
+            args.extend(['-pix_fmt', 'yuv420p'])
+        elif encoder.endswith('_nvenc'):
+            cq = str(crf + NVENC_CQ_OFFSET)
+            args.extend(['-rc', 'vbr', '-cq', cq, '-qmin', cq, '-qmax', cq, '-b:v', '0'])
+        elif encoder.endswith('_qsv'):
+            args.extend(['-global_quality', str(crf)])
+            args.extend(['-pix_fmt', 'nv12'])
+        elif encoder.endswith('_vaapi'):
+            args.extend(['-qp', str(crf)])
+        
+        if self.config['video_profile']:
+            args.extend(['-profile:v', self.config['video_profile']])
+        
+        if filters:
+            args.extend(['-vf', ','.join(filters)])
+        
+        # Audio codec
+        args.extend(['-c:a', 'aac', '-b:a', '128k'])
+        
+        # Put the moov atom first so browsers can start playback before the download ends
+        if suffix.lower() in MOV_EXTENSIONS:
+            args.extend(['-movflags', '+faststart'])
+            # Safari only plays HEVC tagged hvc1; ffmpeg defaults to hev1
+            if encoder.startswith('hevc'):
+                args.extend(['-tag:v', 'hvc1'])
+        
+        return args
 
-    def _compress_image(self, image_path, file_hash):
-        """Compress an image using Pillow with proper orientation handling."""
-        try:
-            img = Image.open(image_path)
-            
-            # Fix orientation based on EXIF data
-            img = self._fix_image_orientation(img)
-            
-            # Convert RGBA to RGB if saving as JPEG
-            if img.mode in ('RGBA', 'LA', 'P') and image_path.suffix.lower() in {'.jpg', '.jpeg'}:
-                rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                rgb_img.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                img = rgb_img
-            
-            # Resize if needed (preserves aspect ratio)
-            max_width = self.config.get('image_max_width')
-            max_height = self.config.get('image_max_height')
-            
-            if max_width is not None or max_height is not None:
-                width, height = img.size
-                scale = 1.0
-                
-                if max_width is not None and width > max_width:
-                    scale = min(scale, max_width / width)
-                if max_height is not None and height > max_height:
-                    scale = min(scale, max_height / height)
-                
-                if scale < 1.0:
-                    new_size = (int(width * scale), int(height * scale))
-                    img = img.resize(new_size, Image.Resampling.LANCZOS)
-                    print(f"[MediaCompressor] Resized {image_path.name}: {width}x{height} → {new_size[0]}x{new_size[1]}")
-            
-            # Save compressed image
-            cached_filename = f"{file_hash}{image_path.suffix}"
-            cached_path = self.cache_dir / cached_filename
-            
-            save_kwargs = {'optimize': True}
-            if image_path.suffix.lower() in {'.jpg', '.jpeg'}:
-                save_kwargs['quality'] = self.config['image_quality']
-            elif image_path.suffix.lower() == '.png':
-                save_kwargs['compress_level'] = 9
-            elif image_path.suffix.lower() == '.webp':
-                save_kwargs['quality'] = self.config['image_quality']
-            
-            img.save(cached_path, **save_kwargs)
-            
-            # Show compression stats
-            original_size = image_path.stat().st_size
-            compressed_size = cached_path.stat().st_size
-            savings = (1 - compressed_size / original_size) * 100
-            print(f"[MediaCompressor] {image_path.name}: {original_size:,} → {compressed_size:,} bytes ({savings:.1f}% reduction)")
-            
-            return cached_path
-            
-        except Exception as e:
-            print(f"[MediaCompressor] Error compressing image {image_path}: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+    def _encode_command(self, video_path):
+        """Build the ffmpeg command (without output path) that re-encodes a video."""
+        return [self._ffmpeg_bin, *self._global_args(), *self._input_args(), '-i', str(video_path), '-y', *self._output_args(video_path.suffix)]
+
+    def _encode_videos(self, videos):
+        """
+        Re-encode several videos with one ffmpeg process, so its startup and
+        any GPU context creation are paid once for the whole batch.
+        Returns {media_file: part_path} for the videos that were encoded.
+        """
+        parts = [
+            (media_file, file_hash, _part_path(self.cache_dir, file_hash, media_file.suffix))
+            for media_file, file_hash in videos
+        ]
+        
+        cmd = [self._ffmpeg_bin, *self._global_args(), '-y']
+        for media_file, _, _ in parts:
+            cmd.extend([*self._input_args(), '-i', str(media_file)])
+        for index, (media_file, _, part_path) in enumerate(parts):
+            cmd.extend([
+                '-map', f'{index}:v:0', '-map', f'{index}:a:0?',
+                *self._output_args(media_file.suffix), str(part_path),
+            ])
+        
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        
+        if result.returncode != 0:
+            log.info(f"[MediaCompressor] Batched ffmpeg failed, encoding videos one by one: {result.stderr}")
+            for _, _, part_path in parts:
+                part_path.unlink(missing_ok=True)
+            return {}
+        
+        return {media_file: part_path for media_file, _, part_path in parts}
 
-    def _compress_video(self, video_path, file_hash):
-        """Compress a video using ffmpeg."""
+    def _compress_video(self, video_path, file_hash, stream):
+        """Compress a video using ffmpeg, given its _probe_video result."""
         # Check if ffmpeg is available
-        if not shutil.which('ffmpeg'):
-            print("[MediaCompressor] ffmpeg not found, skipping video compression")
+        if not self._ffmpeg_bin:
             return None
         
         try:
-            cached_filename = f"{file_hash}{video_path.suffix}"
-            cached_path = self.cache_dir / cached_filename
-            
-            # Build ffmpeg command
-            cmd = ['ffmpeg', '-i', str(video_path), '-y']
+            remux = self._can_copy_video(stream)
             
-            # Video codec settings
-            cmd.extend(['-c:v', 'libx264'])
-            cmd.extend(['-crf', str(self.config['video_crf'])])
-            cmd.extend(['-preset', self.config['video_preset']])
-            
-            # Resize if needed
-            if self.config['video_max_width']:
-                cmd.extend(['-vf', f"scale='min({self.config['video_max_width']},iw)':-2"])
+            if remux:
+                # Already H.264 within limits: a remux can only add faststart
+                if video_path.suffix.lower() not in MOV_EXTENSIONS or _has_faststart(video_path):
+                    log.debug(f"[MediaCompressor] {video_path.name}: already H.264 within limits, keeping original")
+                    return None, False
+                log.debug(f"[MediaCompressor] {video_path.name}: already H.264 within limits, remuxing for faststart")
+                cmd = [self._ffmpeg_bin, '-i', str(video_path), '-y', '-c', 'copy', '-movflags', '+faststart']
+            else:
+                cmd = self._encode_command(video_path)
             
-            # Audio codec
-            cmd.extend(['-c:a', 'aac', '-b:a', '128k'])
+            cached_filename = f"{file_hash}{video_path.suffix}"
+            cached_path = self.cache_dir / cached_filename
+            part_path = _part_path(self.cache_dir, file_hash, video_path.suffix)
             
-            # Output
-            cmd.append(str(cached_path))
+            # Output (renamed into place once ffmpeg succeeds)
+            cmd.append(str(part_path))
             
             # Run ffmpeg
             result = subprocess.run(
@@ -500,18 +1299,19 @@ class MediaCompressorPlugin(BasePlugin):
                 text=True
             )
             
-            if result.returncode == 0 and cached_path.exists():
+            if result.returncode == 0 and part_path.exists():
+                os.replace(part_path, cached_path)
+                
                 # Show compression stats
-                original_size = video_path.stat().st_size
-                compressed_size = cached_path.stat().st_size
-                savings = (1 - compressed_size / original_size) * 100
-                print(f"[MediaCompressor] {video_path.name}: {original_size:,} → {compressed_size:,} bytes ({savings:.1f}% reduction)")
+                _log_savings(video_path, cached_path)
                 
-                return cached_path
+                # A remux is lossless and about the input's size, so it is always kept
+                return cached_path, remux or self._must_replace_video(video_path, stream)
             else:
-                print(f"[MediaCompressor] ffmpeg error: {result.stderr}")
+                log.info(f"[MediaCompressor] ffmpeg error: {result.stderr}")
+                part_path.unlink(missing_ok=True)
                 return None
                 
         except Exception as e:
-            print(f"[MediaCompressor] Error compressing video {video_path}: {e}")
+            log.info(f"[MediaCompressor] Error compressing video {video_path}: {e}")
             return None
\ No newline at end of file
@@ -15,4 +15,8 @@ setup(
         'mkdocs>=1.0',
         'Pillow>=9.0',
     ],
+    extras_require={
+        'vips': ['pyvips>=3.2'],
+        'test': ['pytest'],
+    },
 )
\ No newline at end of file
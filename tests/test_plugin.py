@@ -0,0 +1,458 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import struct
+import sys
+
+import pytest
+from mkdocs.commands.build import build
+from mkdocs.config import load_config
+from PIL import Image
+
+from plugin_mediacompressor.plugin import NOOP_SUFFIX, MediaCompressorPlugin, _has_faststart
+
+# Stand-ins for ffmpeg and ffprobe that log their arguments to $FAKE_FFMPEG_LOG.
+# ffprobe reports $FAKE_FFPROBE[name] or a 640px H.264/AAC stream at 900 kbit/s.
+# ffmpeg passes lavfi test encodes unless $FAKE_FFMPEG_NO_GPU is set, fails
+# multi-input runs if $FAKE_FFMPEG_FAIL_BATCH is set, and writes each output
+# from its mapped input: copied with -c copy, else halved (doubled if
+# $FAKE_FFMPEG_GROW is set).
+FAKE_FFPROBE = f"""\
+#!{sys.executable}
+import json, os, sys
+with open(os.environ['FAKE_FFMPEG_LOG'], 'a') as log:
+    log.write(json.dumps(['ffprobe', *sys.argv[1:]]) + '\\n')
+default = [
+    {{'codec_type': 'video', 'codec_name': 'h264', 'width': 640, 'pix_fmt': 'yuv420p', 'bit_rate': '900000'}},
+    {{'codec_type': 'audio', 'codec_name': 'aac'}},
+]
+streams = json.loads(os.environ.get('FAKE_FFPROBE', '{{}}'))
+print(json.dumps({{'streams': streams.get(os.path.basename(sys.argv[-1]), default)}}))
+"""
+
+FAKE_FFMPEG = f"""\
+#!{sys.executable}
+import json, os, sys
+args = sys.argv[1:]
+with open(os.environ['FAKE_FFMPEG_LOG'], 'a') as log:
+    log.write(json.dumps(['ffmpeg', *args]) + '\\n')
+if 'lavfi' in args:
+    sys.exit(1 if os.environ.get('FAKE_FFMPEG_NO_GPU') else 0)
+inputs = [args[i + 1] for i, arg in enumerate(args) if arg == '-i']
+if len(inputs) > 1 and os.environ.get('FAKE_FFMPEG_FAIL_BATCH'):
+    sys.exit(1)
+source = 0
+for i, arg in enumerate(args):
+    if arg == '-map' and ':v:' in args[i + 1]:
+        source = int(args[i + 1].split(':')[0])
+    elif '.part.' in os.path.basename(arg):
+        with open(inputs[source], 'rb') as f:
+            data = f.read()
+        if 'copy' not in args:
+            data = data * 2 if os.environ.get('FAKE_FFMPEG_GROW') else data[:len(data) // 2]
+        with open(arg, 'wb') as f:
+            f.write(data)
+"""
+
+
+@pytest.fixture
+def project(tmp_path, caplog):
+    """A minimal MkDocs project; images go in docs/img."""
+    caplog.set_level(logging.INFO, logger='mkdocs.plugins.mediacompressor')
+    (tmp_path / 'docs' / 'img').mkdir(parents=True)
+    (tmp_path / 'docs' / 'index.md').write_text('# Test\n')
+    # A bare theme, so the only media in the site are the test's own
+    (tmp_path / 'theme').mkdir()
+    (tmp_path / 'theme' / 'main.html').write_text('{{ page.content }}')
+    write_config(tmp_path)
+    return tmp_path
+
+
+def write_config(project, **options):
+    """Write mkdocs.yml with the given plugin options; videos are skipped unless enabled."""
+    options = {'image_backend': 'pillow', 'skip_videos': True, **options}
+    config = {
+        'site_name': 'Test',
+        'theme': {'name': None, 'custom_dir': 'theme'},
+        'plugins': [{'mediacompressor': options}],
+    }
+    (project / 'mkdocs.yml').write_text(json.dumps(config))
+
+
+def run_build(project, caplog, dirty=False):
+    """Build the project and return the plugin instance and its summary counts."""
+    caplog.clear()
+    config = load_config(str(project / 'mkdocs.yml'))
+    build(config, dirty=dirty)
+
+    summary = re.search(
+        r'Complete: (\d+) processed, (\d+) skipped \(cached\), (\d+) errors', caplog.text
+    )
+    counts = dict(zip(('processed', 'skipped', 'errors'), map(int, summary.groups())))
+    return config['plugins']['mediacompressor'], counts
+
+
+def save_noise_jpeg(path, size=(400, 300), quality=100, seed=64):
+    """Save a noisy JPEG, which compresses well at the plugin's default quality."""
+    Image.effect_noise(size, seed).convert('RGB').save(path, quality=quality)
+
+
+def cached_files(plugin):
+    """Names of compressed files and no-op markers in the cache directory."""
+    return sorted(p.name for p in plugin.cache_dir.iterdir() if not p.name.startswith('.'))
+
+
+def test_compresses_and_reuses_cache(project, caplog):
+    source = project / 'docs' / 'img' / 'photo.jpg'
+    save_noise_jpeg(source)
+
+    plugin, counts = run_build(project, caplog)
+    site_file = project / 'site' / 'img' / 'photo.jpg'
+    assert counts == {'processed': 1, 'skipped': 0, 'errors': 0}
+    assert site_file.stat().st_size < source.stat().st_size
+    [cached_name] = cached_files(plugin)
+    assert site_file.read_bytes() == (plugin.cache_dir / cached_name).read_bytes()
+
+    # A clean rebuild restores the file from cache without compressing it again
+    plugin, counts = run_build(project, caplog)
+    assert counts == {'processed': 0, 'skipped': 1, 'errors': 0}
+    assert site_file.read_bytes() == (plugin.cache_dir / cached_name).read_bytes()
+
+
+def test_stat_shortcut_skips_hashing(project, caplog, monkeypatch):
+    source = project / 'docs' / 'img' / 'photo.jpg'
+    save_noise_jpeg(source)
+    run_build(project, caplog)
+
+    restored = []
+    original = MediaCompressorPlugin._restore_unchanged
+
+    def spy(self, *args):
+        result = original(self, *args)
+        restored.append(result)
+        return result
+
+    monkeypatch.setattr(MediaCompressorPlugin, '_restore_unchanged', spy)
+
+    _, counts = run_build(project, caplog)
+    assert restored == [True]
+    assert counts['processed'] == 0
+
+    # A new mtime defeats the shortcut, but the hash still hits the cache
+    restored.clear()
+    stat = source.stat()
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    _, counts = run_build(project, caplog)
+    assert restored == [False]
+    assert counts == {'processed': 0, 'skipped': 1, 'errors': 0}
+
+
+def test_noop_keeps_original(project, caplog):
+    # Already heavily compressed, so re-encoding at quality 85 only grows it
+    source = project / 'docs' / 'img' / 'small.jpg'
+    save_noise_jpeg(source, quality=20)
+
+    plugin, counts = run_build(project, caplog)
+    site_file = project / 'site' / 'img' / 'small.jpg'
+    assert counts['processed'] == 1
+    assert site_file.read_bytes() == source.read_bytes()
+    [marker] = cached_files(plugin)
+    assert marker.endswith(NOOP_SUFFIX)
+
+    _, counts = run_build(project, caplog)
+    assert counts == {'processed': 0, 'skipped': 1, 'errors': 0}
+    assert site_file.read_bytes() == source.read_bytes()
+
+
+def test_required_resize_is_kept_even_if_larger(project, caplog):
+    write_config(project, image_max_width=900)
+    save_noise_jpeg(project / 'docs' / 'img' / 'small.jpg', size=(1000, 800), quality=20)
+
+    plugin, counts = run_build(project, caplog)
+    assert counts['processed'] == 1
+    with Image.open(project / 'site' / 'img' / 'small.jpg') as img:
+        assert img.size == (900, 720)
+    assert not any(name.endswith(NOOP_SUFFIX) for name in cached_files(plugin))
+
+
+def test_config_change_clears_cache(project, caplog):
+    save_noise_jpeg(project / 'docs' / 'img' / 'photo.jpg')
+    plugin, _ = run_build(project, caplog)
+    first_cache = cached_files(plugin)
+    first_size = (project / 'site' / 'img' / 'photo.jpg').stat().st_size
+
+    write_config(project, image_quality=50)
+    plugin, counts = run_build(project, caplog)
+    assert 'Configuration changed' in caplog.text
+    assert counts == {'processed': 1, 'skipped': 0, 'errors': 0}
+    assert cached_files(plugin) == first_cache
+    assert (project / 'site' / 'img' / 'photo.jpg').stat().st_size < first_size
+
+    with sqlite3.connect(plugin.cache_file) as db:
+        config = json.loads(db.execute("SELECT value FROM meta WHERE key = 'config'").fetchone()[0])
+    assert config['image_quality'] == 50
+
+
+def test_dirty_rebuild_does_not_write_into_cache(project, caplog):
+    source = project / 'docs' / 'img' / 'photo.jpg'
+    save_noise_jpeg(source)
+    plugin, _ = run_build(project, caplog)
+
+    site_file = project / 'site' / 'img' / 'photo.jpg'
+    assert site_file.stat().st_nlink > 1
+    [cached_name] = cached_files(plugin)
+    cached_bytes = (plugin.cache_dir / cached_name).read_bytes()
+
+    # MkDocs copies the changed source over the site file, which is a hard link into the cache
+    save_noise_jpeg(source, seed=32)
+    stat = source.stat()
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    plugin, counts = run_build(project, caplog, dirty=True)
+
+    assert counts['processed'] == 1
+    assert (plugin.cache_dir / cached_name).read_bytes() == cached_bytes
+    assert site_file.read_bytes() != cached_bytes
+
+
+def test_duplicates_share_output_only_within_a_format(project, caplog):
+    img_dir = project / 'docs' / 'img'
+    # Barely compressed, so both PNG and WebP output come out smaller
+    Image.linear_gradient('L').convert('RGB').save(img_dir / 'a.png', compress_level=0)
+    (img_dir / 'b.png').write_bytes((img_dir / 'a.png').read_bytes())
+    # Same bytes, but the output is written as WebP, so it can't be shared
+    (img_dir / 'c.webp').write_bytes((img_dir / 'a.png').read_bytes())
+
+    _, counts = run_build(project, caplog)
+    site_dir = project / 'site' / 'img'
+    assert counts == {'processed': 2, 'skipped': 1, 'errors': 0}
+    assert os.path.samefile(site_dir / 'a.png', site_dir / 'b.png')
+    with Image.open(site_dir / 'a.png') as img:
+        assert img.format == 'PNG'
+    with Image.open(site_dir / 'c.webp') as img:
+        assert img.format == 'WEBP'
+
+
+def test_corrupt_manifest_is_replaced(project, caplog):
+    save_noise_jpeg(project / 'docs' / 'img' / 'photo.jpg')
+    plugin, _ = run_build(project, caplog)
+    for suffix in ('-wal', '-shm'):
+        plugin.cache_file.with_name(plugin.cache_file.name + suffix).unlink(missing_ok=True)
+    plugin.cache_file.write_bytes(b'not a database')
+
+    _, counts = run_build(project, caplog)
+    assert 'Error loading cache' in caplog.text
+    assert counts == {'processed': 1, 'skipped': 0, 'errors': 0}
+
+    # The fresh manifest is stamped, so the next build reuses the cache
+    _, counts = run_build(project, caplog)
+    assert 'Old cache format' not in caplog.text
+    assert counts == {'processed': 0, 'skipped': 1, 'errors': 0}
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    """Put stub ffmpeg/ffprobe first on PATH; returns a function reading their calls."""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for name, script in (('ffmpeg', FAKE_FFMPEG), ('ffprobe', FAKE_FFPROBE)):
+        (bin_dir / name).write_text(script)
+        (bin_dir / name).chmod(0o755)
+    log_file = tmp_path / 'ffmpeg.log'
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('FAKE_FFMPEG_LOG', str(log_file))
+
+    def calls(program='ffmpeg'):
+        if not log_file.exists():
+            return []
+        lines = [json.loads(line) for line in log_file.read_text().splitlines()]
+        return [line[1:] for line in lines if line[0] == program]
+    return calls
+
+
+def box(box_type, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def write_video(path, faststart=False):
+    """Write an MP4-shaped file of distinct content, with moov before or after mdat."""
+    moov = box(b'moov', path.name.encode())
+    mdat = box(b'mdat', path.name.encode() * 200)
+    path.write_bytes(box(b'ftyp', b'isom') + (moov + mdat if faststart else mdat + moov))
+
+
+def encodes(calls):
+    """The ffmpeg calls that write videos, i.e. not test encodes."""
+    return [args for args in calls() if 'lavfi' not in args]
+
+
+def outputs(args):
+    """Split an ffmpeg command into (output_path, options_before_it) pairs."""
+    last_input = max(i for i, arg in enumerate(args) if arg == '-i') + 1
+    result, start = [], last_input + 1
+    for i in range(start, len(args)):
+        if '.part.' in os.path.basename(args[i]):
+            result.append((args[i], args[start:i]))
+            start = i + 1
+    return result
+
+
+def test_has_faststart(tmp_path):
+    video = tmp_path / 'a.mp4'
+    write_video(video, faststart=True)
+    assert _has_faststart(video)
+    write_video(video, faststart=False)
+    assert not _has_faststart(video)
+
+    # 64-bit box sizes are followed to the next box
+    free = struct.pack('>I4sQ', 1, b'free', 24) + b'\0' * 8
+    video.write_bytes(box(b'ftyp', b'isom') + free + box(b'moov'))
+    assert _has_faststart(video)
+
+    video.write_bytes(b'not a video')
+    assert not _has_faststart(video)
+
+
+def test_batch_maps_each_output_to_its_input(project, caplog, fake_ffmpeg):
+    write_config(project, skip_videos=False, video_batch_size=3)
+    names = ['a.mp4', 'b.mkv', 'c.mov']
+    for name in names:
+        write_video(project / 'docs' / 'img' / name)
+
+    _, counts = run_build(project, caplog)
+    assert counts == {'processed': 3, 'skipped': 0, 'errors': 0}
+    [cmd] = encodes(fake_ffmpeg)
+
+    inputs = [os.path.basename(cmd[i + 1]) for i, arg in enumerate(cmd) if arg == '-i']
+    assert sorted(inputs) == names
+    for index, (output, options) in enumerate(outputs(cmd)):
+        assert options[:4] == ['-map', f'{index}:v:0', '-map', f'{index}:a:0?']
+        assert output.endswith(inputs[index][-4:])
+        assert ('+faststart' in options) == inputs[index].endswith(('.mp4', '.mov'))
+        assert options[options.index('-pix_fmt') + 1] == 'yuv420p'
+
+    for name in names:
+        source = project / 'docs' / 'img' / name
+        assert (project / 'site' / 'img' / name).stat().st_size == source.stat().st_size // 2
+
+
+def test_failed_batch_encodes_one_by_one(project, caplog, fake_ffmpeg, monkeypatch):
+    monkeypatch.setenv('FAKE_FFMPEG_FAIL_BATCH', '1')
+    write_config(project, skip_videos=False, video_batch_size=2)
+    for name in ('a.mp4', 'b.mp4'):
+        write_video(project / 'docs' / 'img' / name)
+
+    plugin, counts = run_build(project, caplog)
+    assert counts == {'processed': 2, 'skipped': 0, 'errors': 0}
+    assert 'encoding videos one by one' in caplog.text
+    batch, *single = encodes(fake_ffmpeg)
+    assert batch.count('-i') == 2
+    assert [args.count('-i') for args in single] == [1, 1]
+    # Nothing is left behind from the failed batch
+    assert not [name for name in cached_files(plugin) if '.part.' in name]
+
+
+def test_copyable_videos_are_remuxed_or_kept(project, caplog, fake_ffmpeg, monkeypatch):
+    monkeypatch.setenv('FAKE_FFPROBE', json.dumps({
+        'pcm.mkv': [
+            {'codec_type': 'video', 'codec_name': 'h264', 'width': 640, 'pix_fmt': 'yuv420p', 'bit_rate': '900000'},
+            {'codec_type': 'audio', 'codec_name': 'pcm_s16le'},
+        ],
+    }))
+    write_config(project, skip_videos=False, video_copy_max_bitrate=1000)
+    img_dir = project / 'docs' / 'img'
+    write_video(img_dir / 'slow.mp4')
+    write_video(img_dir / 'fast.mp4', faststart=True)
+    write_video(img_dir / 'plain.mkv')
+    write_video(img_dir / 'pcm.mkv')
+
+    plugin, counts = run_build(project, caplog)
+    assert counts == {'processed': 4, 'skipped': 0, 'errors': 0}
+    [remux] = [args for args in encodes(fake_ffmpeg) if 'copy' in args]
+    [encode] = [args for args in encodes(fake_ffmpeg) if 'copy' not in args]
+
+    # Only the MP4 without faststart is remuxed; it is kept although not smaller
+    assert remux[remux.index('-i') + 1].endswith('slow.mp4')
+    assert remux[remux.index('-c') + 1] == 'copy' and '+faststart' in remux
+    assert (project / 'site' / 'img' / 'slow.mp4').read_bytes() == (img_dir / 'slow.mp4').read_bytes()
+    # PCM audio has to be re-encoded to AAC
+    assert encode[encode.index('-i') + 1].endswith('pcm.mkv')
+    assert encode[encode.index('-c:a') + 1] == 'aac'
+
+    markers = [name for name in cached_files(plugin) if name.endswith(NOOP_SUFFIX)]
+    assert len(markers) == 2
+
+
+def test_must_replace_output_is_kept_even_if_larger(project, caplog, fake_ffmpeg, monkeypatch):
+    monkeypatch.setenv('FAKE_FFMPEG_GROW', '1')
+    monkeypatch.setenv('FAKE_FFPROBE', json.dumps({
+        'wide.mkv': [{'codec_type': 'video', 'codec_name': 'h264', 'width': 3840, 'pix_fmt': 'yuv420p'}],
+        'yuv444.mkv': [{'codec_type': 'video', 'codec_name': 'hevc', 'width': 640, 'pix_fmt': 'yuv444p'}],
+    }))
+    write_config(project, skip_videos=False, video_max_width=1920)
+    img_dir = project / 'docs' / 'img'
+    for name in ('wide.mkv', 'yuv444.mkv', 'plain.mkv', 'faststart.mp4'):
+        write_video(img_dir / name, faststart=name == 'faststart.mp4')
+    write_video(img_dir / 'slow.mov')
+
+    plugin, counts = run_build(project, caplog)
+    assert counts == {'processed': 5, 'skipped': 0, 'errors': 0}
+    site_dir = project / 'site' / 'img'
+    for name in ('wide.mkv', 'yuv444.mkv', 'slow.mov'):
+        assert site_dir.joinpath(name).stat().st_size == 2 * img_dir.joinpath(name).stat().st_size
+    for name in ('plain.mkv', 'faststart.mp4'):
+        assert site_dir.joinpath(name).read_bytes() == img_dir.joinpath(name).read_bytes()
+    assert len([name for name in cached_files(plugin) if name.endswith(NOOP_SUFFIX)]) == 2
+
+
+def test_unavailable_gpu_encoder_keeps_image_cache(project, caplog, fake_ffmpeg, monkeypatch):
+    monkeypatch.setenv('FAKE_FFMPEG_NO_GPU', '1')
+    write_config(project, skip_videos=False, video_encoder='h264_nvenc')
+    save_noise_jpeg(project / 'docs' / 'img' / 'photo.jpg')
+    write_video(project / 'docs' / 'img' / 'a.mp4')
+
+    _, counts = run_build(project, caplog)
+    assert 'h264_nvenc not available' in caplog.text
+    assert counts == {'processed': 2, 'skipped': 0, 'errors': 0}
+    [encode] = encodes(fake_ffmpeg)
+    assert encode[encode.index('-c:v') + 1] == 'libx264'
+
+    _, counts = run_build(project, caplog)
+    assert 'Configuration changed' not in caplog.text
+    assert counts == {'processed': 0, 'skipped': 2, 'errors': 0}
+
+
+def test_missing_ffmpeg_skips_videos(project, caplog, monkeypatch):
+    monkeypatch.setenv('PATH', str(project / 'empty'))
+    write_config(project, skip_videos=False, video_encoder='h264_nvenc')
+    write_video(project / 'docs' / 'img' / 'a.mp4')
+
+    _, counts = run_build(project, caplog)
+    assert counts == {'processed': 0, 'skipped': 1, 'errors': 0}
+    assert 'ffmpeg not found' in caplog.text
+    assert 'not available' not in caplog.text
+    assert (project / 'site' / 'img' / 'a.mp4').read_bytes() == (project / 'docs' / 'img' / 'a.mp4').read_bytes()
+
+
+@pytest.mark.parametrize('encoder, suffix, expected', [
+    ('libx264', '.mp4', ['-crf', '23', '-preset', 'faster', '-pix_fmt', 'yuv420p', '-movflags', '+faststart']),
+    ('h264_nvenc', '.mkv', ['-cq', '27', '-vf', 'scale_cuda=format=yuv420p']),
+    ('hevc_nvenc', '.mov', ['-vf', "scale_cuda='min(1280,iw)':-2:format=yuv420p", '-tag:v', 'hvc1']),
+    ('h264_qsv', '.mp4', ['-global_quality', '23', '-pix_fmt', 'nv12']),
+    ('h264_vaapi', '.mkv', ['-qp', '23', '-vf', 'format=nv12,hwupload']),
+])
+def test_encoder_output_args(encoder, suffix, expected):
+    plugin = MediaCompressorPlugin()
+    options = {'video_encoder': encoder}
+    if expected[1].startswith('scale_cuda=') and 'min' in expected[1]:
+        options['video_max_width'] = 1280
+    plugin.load_config(options)
+
+    args = plugin._output_args(suffix)
+    assert args[:2] == ['-c:v', encoder]
+    for i in range(0, len(expected), 2):
+        assert args[args.index(expected[i]) + 1] == expected[i + 1]
+    assert args[args.index('-c:a') + 1] == 'aac'
+    if suffix == '.mkv':
+        assert '-movflags' not in args